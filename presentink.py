@@ -3,7 +3,8 @@
 # Convert an Inkscape SVG file into a set of PDF slides for presentation
 # or printing.
 #
-# Requires inkscape and pdftk to be installed and in the PATH.
+# Requires inkscape (1.1 or newer) to be installed and in the PATH, and the pypdf
+# python package.
 #
 # This is a fork of mkpdfs.py (https://gist.github.com/stevenbell/909c79c9396f932942476e658b38d80c)
 # from Steven Bell, which in turn was inspired by mkpdfs.rb (https://gist.github.com/emk/961877)
@@ -25,238 +26,598 @@
 # There are a set of special tags that will get filled in when placed in a text
 # field as ${tag}.  Currently the only tag is ${slide}, which inserts the slide
 # number.  This only works for normal text fields, not text boxes.
+#
+# Running "presentink.py --daemon" keeps one inkscape process per cpu open in the background.
+# While it runs, calls to presentink.py from the same directory send their slides to
+# it through .tmpdir/sock, instead of starting inkscape themselves.
 
 from lxml import etree
+from pypdf import PdfWriter
+from pypdf.errors import PyPdfError
 import os
+import re
+import sys
 from sys import argv
-import filecmp
-import copy
+import hashlib
+import shutil
+import subprocess
+import concurrent.futures
+import threading
+import queue
+import socket
+import socketserver
+import signal
+import time
+
+# Inkscape sessions
+class InkscapeShell:
+    # An "inkscape --shell" process, which runs one line of actions at a time
+    def __init__(self):
+        self.process = subprocess.Popen(["inkscape", "--shell"], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        self.alive = self.wait_for_prompt()
+
+    def wait_for_prompt(self):
+        # inkscape prints "> " when it is ready for the next command. Returns False if
+        # inkscape exited instead.
+        output = b""
+        while not output.endswith(b"> "):
+            chunk = os.read(self.process.stdout.fileno(), 4096)
+            if not chunk:
+                return False
+            output += chunk
+        return True
+
+    def run(self, command):
+        # Returns False if inkscape died before finishing the command
+        if not self.alive:
+            return False
+        try:
+            self.process.stdin.write(command.encode())
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            self.alive = False
+            return False
+        self.alive = self.wait_for_prompt()
+        return self.alive
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return self.process.wait()
+
+class DaemonShell:
+    # Connection to one of the inkscape shells kept running by "presentink.py --daemon"
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.stream = self.sock.makefile('rwb')
+
+    def run(self, command):
+        # Returns False if the command failed, or the daemon went away
+        try:
+            self.stream.write(command.encode())
+            self.stream.flush()
+            return self.stream.readline() == b"ok\n"
+        except OSError:
+            return False
+
+    def close(self):
+        # Only disconnect, the daemon keeps inkscape running for the next time
+        try:
+            self.stream.close()
+        except OSError:
+            pass
+        self.sock.close()
+        return 0
+
+def daemon_running(socket_path):
+    # Returns True if a daemon is listening on socket_path
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        DaemonShell(socket_path).close()
+    except OSError:
+        return False
+    return True
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    # Forward every line received to one of the inkscape shells of the daemon.
+    # A shell is only taken from the pool once the first command arrives.
+    def handle(self):
+        shell = None
+        try:
+            for command in self.rfile:
+                if shell is None:
+                    shell = self.server.shells.get()
+                if not shell.alive:
+                    # inkscape died on an earlier command, start a new one
+                    shell.close()
+                    shell = InkscapeShell()
+                if shell.run(command.decode()):
+                    self.wfile.write(b"ok\n")
+                else:
+                    self.wfile.write(b"error\n")
+        finally:
+            if shell is not None:
+                self.server.shells.put(shell)
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Serves every connection in its own thread, with a pool of inkscape shells
+    daemon_threads = True
+
+def run_daemon(socket_path):
+    # Keep one inkscape shell per cpu running, so later runs do not pay for their startup
+    if daemon_running(socket_path):
+        print("An inkscape daemon is already listening on "+socket_path)
+        exit()
+    # nobody answers on the socket, so it was left behind by a daemon that crashed
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    num_shells = os.cpu_count() or 1
+    server = DaemonServer(socket_path, DaemonHandler)
+    socket_inode = os.stat(socket_path).st_ino
+    server.shells = queue.Queue()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_shells) as executor:
+        for shell in executor.map(lambda k: InkscapeShell(), range(num_shells)):
+            server.shells.put(shell)
+    print("Inkscape daemon with {} shells listening on {}".format(num_shells, socket_path))
+    # stop cleanly when terminated, not only on ctrl-c
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        while not server.shells.empty():
+            server.shells.get().close()
+        # only remove the socket if it was not replaced by another daemon in the meantime
+        try:
+            if os.stat(socket_path).st_ino == socket_inode:
+                os.remove(socket_path)
+        except FileNotFoundError:
+            pass
 
 # Configuration
 if len(argv) < 2:
     print("Incorrect number of arguments")
-    print("Usage: presentink.py SVGFILE\n")
+    print("Usage: presentink.py SVGFILE")
+    print("       presentink.py --daemon\n")
     exit()
 
-srcfile = argv[1]
 tmpdir = '.tmpdir'
-tmpsvg = tmpdir+os.path.sep+'temp.svg'
+daemon_socket = tmpdir+os.path.sep+'sock'
+if argv[1] == '--daemon':
+    os.makedirs(tmpdir, exist_ok=True)
+    run_daemon(daemon_socket)
+    exit()
+
+srcfile = argv[1]
+cachedir = tmpdir+os.path.sep+'cache' # rendered pdfs, named by the hash of their svg
 coalesce_animations = False # Whether to flatten animations for printouts
+cache_max_age = 30 # Days after which unused pdfs are removed from the cache
+
+os.makedirs(cachedir, exist_ok=True)
+
+def link_pdf(cache_pdf, pdf_name):
+    # Make pdf_name point to the cached pdf, copying it if hard links are not supported
+    if os.path.lexists(pdf_name):
+        os.remove(pdf_name)
+    try:
+        os.link(cache_pdf, pdf_name)
+    except OSError:
+        shutil.copyfile(cache_pdf, pdf_name)
 
-if not os.path.isdir(tmpdir):
-    os.system("mkdir "+tmpdir)
+def prune_cache():
+    # Remove cached pdfs no run has used for cache_max_age days, together with
+    # partial exports left behind by crashed inkscape sessions. Other decks and
+    # older versions of this one may share the cache, so recent entries are kept.
+    oldest = time.time() - cache_max_age*24*3600
+    for name in os.listdir(cachedir):
+        path = cachedir + os.path.sep + name
+        if name.endswith(".partial.pdf") or os.path.getmtime(path) < oldest:
+            os.remove(path)
+
+# Load the file and get the namespaces.
+# The file is parsed incrementally, picking up the top level layers as they are
+# completed and dropping the namedview elements right away. These contain
+# unnecesary information, which otherwise leads to unnecesary inkscape stuff
+# causing recreation of pdfs.
+layer_tag = '{http://www.w3.org/2000/svg}g'
+namedview_tag = '{http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd}namedview'
+groupmode_attr = '{http://www.inkscape.org/namespaces/inkscape}groupmode'
+label_attr = '{http://www.inkscape.org/namespaces/inkscape}label'
+# The id table is not needed, so lxml does not have to build it.
+context = etree.iterparse(srcfile, events=("end",), tag=(layer_tag, namedview_tag),
+        huge_tree=True, collect_ids=False)
+layers = []
+namedview_count = 0
+for event, element in context:
+    parent = element.getparent()
+    if parent is None or parent.getparent() is not None:
+        # only direct children of the root are of interest
+        continue
+    if element.tag == namedview_tag:
+        parent.remove(element)
+        element.clear()
+        namedview_count += 1
+    elif element.get(groupmode_attr) == 'layer':
+        layers.append(element)
+doc = context.root.getroottree()
+del context
+if namedview_count == 0:
+    print("Did not find information to strip in inkscape file, continuing")
 
-# Load the file and get the namespaces
-doc = etree.fromstringlist(open(srcfile)).getroottree()
 ns = doc.getroot().nsmap
-layers = doc.findall('/svg:g[@inkscape:groupmode="layer"]', namespaces=ns)
+# Inkscape declares the svg namespace both as default and with the "svg" prefix. Elements
+# that are moved around in the document (sublayers, hidden layers) would pick up the prefix, so drop
+# that declaration if nothing uses it.
+etree.cleanup_namespaces(doc, keep_ns_prefixes=[prefix for prefix in ns if prefix not in (None, 'svg')])
+
+# Compile the queries used on the document once. XPath does not support a default
+# namespace, so leave it out of the namespace map
+xpath_ns = {prefix: uri for prefix, uri in ns.items() if prefix is not None}
+xpath_ns.setdefault('svg', 'http://www.w3.org/2000/svg')
+layer_xpath = etree.XPath('/svg:svg/svg:g[@inkscape:groupmode="layer"]', namespaces=xpath_ns)
+sublayer_xpath = etree.XPath('svg:g[@inkscape:groupmode="layer"]', namespaces=xpath_ns)
+tspan_xpath = etree.XPath('//svg:tspan', namespaces=xpath_ns)
+# Special tags in layer names: $SETPNUM=N, $SETPNUM+, $SETPNUM- and $SKIPRENDER
+label_tag_re = re.compile(r'\$SETPNUM=\s*(?P<value>[^\s$]*)|\$SETPNUM(?P<step>[+-])|\$(?P<skip>SKIPRENDER)')
+
+defs_tag = '{http://www.w3.org/2000/svg}defs'
+text_tags = ('{http://www.w3.org/2000/svg}text', '{http://www.w3.org/2000/svg}tspan')
+
+def slide_hash(doc):
+    # Hash the document as it will be rendered, in a single walk over the tree.
+    # Hidden layers are skipped, as they are not part of the slide.
+    # The top level "defs" element is skipped as well. Layers marked as not visible can change
+    # this section, triggering a full render of all slides for small changes.
+    # text and tspan elements can swap ids even with small changes in different slides,
+    # so ids inside text are ignored to prevent artificial rerendering of all doc.
+    h = hashlib.blake2b()
+    root = doc.getroot()
+    skipped = None
+    text_depth = 0
+    walker = etree.iterwalk(doc, events=('start', 'end', 'comment', 'pi'))
+    for event, element in walker:
+        if event in ('comment', 'pi'):
+            # these are not rendered, but the text that follows them is
+            h.update(b'\3' + (element.tail or '').encode() + b'\3')
+        elif event == 'start':
+            # only the top level "defs" element and layers are skipped
+            if element.getparent() is root and (element.tag == defs_tag or
+                    (element.tag == layer_tag and element.get('style') == 'display:none')):
+                walker.skip_subtree()
+                skipped = element
+                continue
+            if element.tag in text_tags:
+                text_depth += 1
+            h.update(str(element.tag).encode())
+            for name, value in sorted(element.attrib.items()):
+                if text_depth > 0 and name == 'id':
+                    continue
+                h.update(b'\0' + name.encode() + b'=' + value.encode())
+            h.update(b'\1' + (element.text or '').encode() + b'\1')
+        else:
+            if element is skipped:
+                skipped = None
+                continue
+            if element.tag in text_tags:
+                text_depth -= 1
+            h.update(b'\2' + (element.tail or '').encode() + b'\2')
+    return h.hexdigest()
 
 ##clean ids so that rerenders are not triggered by spurious id changes
 #for element in doc.iter():
 #    print(element.attrib['id'])
 
-#remove unnecesary information, otherwise this leads to unnecesary inkscape stuff causing recreation of pdfs
-namedviews = doc.findall("{"+ns["sodipodi"]+'}namedview')
-if len(namedviews) == 0:
-    print("Did not find information to strip in inkscape file, continuing")
-for namedview in namedviews:
-    namedview.getparent().remove(namedview)
-
 # Find all the text strings that we're going to have to replace
-texts = doc.findall('//tspan', namespaces=ns)
+texts = tspan_xpath(doc)
 subst_elements = [] # Text elements where we have to substitute something
-subst_strings = [] # The corresponding strings of text
+subst_templates = [] # The corresponding strings of text, split at each '$PNUM'
 
 for t in texts:
-    if t.text != None and t.text.find('$PNUM') != -1:
+    if t.text is not None and '$PNUM' in t.text:
         subst_elements.append(t)
-        subst_strings.append(t.text)
+        subst_templates.append(t.text.split('$PNUM'))
 
 # Zeroth pass:
 # If some layers have sublayers, flatten the document by making the sublayers
 # main layers with "+" pre-pended to the name.
 # This only goes one layer deep
 for l in layers:
-    sublayers = l.findall('g[@inkscape:groupmode="layer"]', namespaces=ns)[::-1]
+    sublayers = sublayer_xpath(l)[::-1]
     for sl in sublayers:
         # add a '+' to the label so we know this is a sublayer
         # add nothing if the slide already has a specific symbol
         l.addnext(sl)
-        label = sl.attrib['{'+ns['inkscape']+'}label']
-        if (len(label)>0 and label[0] not in ['+','_','!','-','.']):
-            sl.attrib['{'+ns['inkscape']+'}label'] = "+"+label
-layers = doc.findall('/svg:g[@inkscape:groupmode="layer"]', namespaces=ns)
+        label = sl.attrib[label_attr]
+        if (len(label)>0 and not label.startswith(('+','_','!','-','.'))):
+            sl.attrib[label_attr] = "+"+label
+layers = layer_xpath(doc)
+labels = [l.attrib[label_attr] for l in layers]
+first_chars = [label[:1] for label in labels] # empty for layers without a name
 
 # First pass:
 # Make all of the layers invisible
 # and find the last layer which should be visible
 last_visible_layer = None
-for l in layers:
+for l, first_char in zip(layers, first_chars):
     l.attrib['style'] = 'display:none'
-    label = l.attrib['{'+ns['inkscape']+'}label']
-    if label[0] != '.' and label[0] != '_':
+    if first_char not in ('.', '_'):
         last_visible_layer = l
 
 # Second pass:
-# Build up the layers and create files
-slide_num = 0 # Number of each slide used when saving temporary files
-actual_slide_num = 0 # Number that we put into slides
-page_count = 0 # Used to name the PDF files we export, name is (slide_num)_(page_count),
-               # and page count is reset for each new normal layer.
+# Build up the layers and create files. Only the svg files of slides that are not
+# in the cache are written, and they are collected in render_queue. Inkscape is not
+# called from this loop; all of render_queue is handed to it afterwards.
+class SlideState:
+    # Layers and counters carried from one layer to the next
+    def __init__(self):
+        self.slide_num = 0 # Number of each slide used when saving temporary files
+        self.actual_slide_num = 0 # Number that we put into slides
+        self.page_count = 0 # Used to name the PDF files we export, name is (slide_num)_(page_count),
+                            # and page count is reset for each new normal layer.
+
+        self.base_layers = [] # Layers which are always shown once added
+        self.visible_layers = [] # Layers visible in current slide
+        self.additional_layers = [] # Layers marked with + (or that were sublayers)
+
+# Each handler processes a layer according to the first character of its label, and
+# returns True if a slide has to be rendered for it.
+def trim_layers(layer_list, label):
+    # if slide title is just the symbol, clear all slides
+    if len(label) == 1:
+        return []
+    #text after the symbol should be an integer, and will remove
+    # as many slides as indicated
+    try:
+        number_to_remove = int(label[1:])
+    except ValueError:
+        #Handle the exception
+        print("ERROR: wrong name for layer titled "+label)
+        print("layers starting with '"+label[0]+"' should have an integer, or nothing following")
+        sys.exit(0)
+    if len(layer_list) < number_to_remove:
+        return []
+    return layer_list[:len(layer_list)-number_to_remove]
+
+def handle_hidden(l, label, state):
+    # Hidden, just skip this layer
+    return False
+
+def handle_remove_additional(l, label, state):
+    # clear additional layers and go to the next one
+    state.additional_layers = trim_layers(state.additional_layers, label)
+    return False
+
+def handle_remove_base(l, label, state):
+    # clear base layers and go to the next one. Change will appear
+    # at the next normal slide
+    state.base_layers = trim_layers(state.base_layers, label)
+    return False
+
+def handle_base(l, label, state):
+    # Base layer, add it to the list but don't make a slide for it
+    state.base_layers.append(l)
+    return False
 
-base_layers = [] # Layers which are always shown once added
-visible_layers = [] # Layers visible in current slide
-additional_layers = [] # Layers marked with + (or that were sublayers)
+def handle_additive(l, label, state):
+    # Additive layer, just append it to the current list
+    state.additional_layers.append(l)
+    return True
 
-pdf_path_list = "" # string with names of all pdfs to join
+def handle_normal(l, label, state):
+    # Normal case, reset all the layers and add this one
+    state.additional_layers = []
+    state.visible_layers = state.base_layers + [l]
+    state.slide_num += 1
+    state.actual_slide_num += 1
+    state.page_count = 0
+    return True
+
+layer_handlers = {
+    '.': handle_hidden,
+    '-': handle_remove_additional,
+    '!': handle_remove_base,
+    '_': handle_base,
+    '+': handle_additive,
+}
+
+state = SlideState()
+
+pages = [] # (cached pdf, pdf) pairs for all pages to join, in order
+render_queue = [] # (svg, pdf) pairs that need to be rendered by inkscape
+queued_keys = set() # hashes of the slides already in render_queue
+prev_visible = set() # layers shown in the previous slide
 
 for i,l in enumerate(layers):
 
-    label = l.attrib['{'+ns['inkscape']+'}label']
-    if label[0] == '.':
-        # Hidden, just skip this layer
-        continue
-    elif label[0] == '-':
-        # clear additional layers and go to the next one
-        # if slide title is just "-", clear all additional slides
-        if len(label) == 1:
-            additional_layers = []
-        else:
-            #text after "-" should be an integer, and will remove
-            # as many slides as indicated
-            try:
-                number_to_remove = int(label[1:])
-                if len(additional_layers) < number_to_remove:
-                    additional_layers = []
-                else:
-                    additional_layers = additional_layers[:len(additional_layers)-number_to_remove]
-            except ValueError:
-                #Handle the exception
-                print("ERROR: wrong name for layer titled "+label)
-                print("layers starting with '-' should have an integer, or nothing following")
-                sys.exit(0)
-        continue
-    elif label[0] == '!':
-        # clear base layers and go to the next one. Change will appear
-        # at the next normal slide
-        # if slide title is just "!", clear all base slides
-        if len(label) == 1:
-            base_layers = []
-        else:
-            #text after "!" should be an integer, and will remove
-            # as many slides as indicated
-            try:
-                number_to_remove = int(label[1:])
-                if len(base_layers) < number_to_remove:
-                    base_layers = []
-                else:
-                    base_layers = base_layers[:len(base_layers)-number_to_remove]
-            except ValueError:
-                #Handle the exception
-                print("ERROR: wrong name for layer titled "+label)
-                print("layers starting with '!' should have an integer, or nothing following")
-                sys.exit(0)
-        continue
-    elif label[0] == '_':
-        # Base layer, add it to the list but don't make a slide for it
-        base_layers.append(l)
+    label = labels[i]
+    handler = layer_handlers.get(first_chars[i], handle_normal)
+    if not handler(l, label, state):
         continue
-    elif label[0] == '+':
-        # Additive layer, just append it to the current list
-        additional_layers.append(l);
-    else:
-        # Normal case, reset all the layers and add this one
-        additional_layers = []
-        visible_layers = base_layers + [l];
-        slide_num += 1
-        actual_slide_num += 1
-        page_count = 0
 
     if coalesce_animations and l != last_visible_layer:
-        next_label = layers[i+1].attrib['{http://www.inkscape.org/namespaces/inkscape}label']
-        if next_label[0] == '+' or next_label[0] == '.':
+        if first_chars[i+1] in ('+', '.'):
             # Then don't render just yet
             continue
 
-    for vl in visible_layers + additional_layers:
+    # Only change the style of layers that differ from the previous slide
+    cur_visible = set(state.visible_layers + state.additional_layers)
+    for vl in cur_visible - prev_visible:
         vl.attrib['style'] = 'display:inline'
+    for vl in prev_visible - cur_visible:
+        vl.attrib['style'] = 'display:none'
+    prev_visible = cur_visible
 
     # Check for any adjustements to slide number
-    setpnum_index = label.find("$SETPNUM=")
-    if (setpnum_index != -1):
+    # Each tag is applied at most once, "=" first, then "-" and then "+"
+    tags = {} # '=', '-', '+' or 'skip' -> first match of that tag
+    for match in label_tag_re.finditer(label):
+        if match.group('value') is not None:
+            tags.setdefault('=', match)
+        else:
+            tags.setdefault(match.group('step') or 'skip', match)
+    if '=' in tags:
         try:
-            actual_slide_num = int(label[label.find("$SETPNUM=")+len("$SETPNUM="):])
+            state.actual_slide_num = int(tags['='].group('value'))
         except ValueError:
             print("Error when using $SETPNUM in slide "+label)
-    if (label.find("$SETPNUM-") != -1):
-        actual_slide_num -= 1
-    if (label.find("$SETPNUM+") != -1):
-        actual_slide_num += 1
+    if '-' in tags:
+        state.actual_slide_num -= 1
+    if '+' in tags:
+        state.actual_slide_num += 1
 
-    if (label.find("$SKIPRENDER") != -1):
+    if 'skip' in tags:
         continue
 
     # Do the string substitutions
-    for s in range(len(subst_elements)):
-        subst_elements[s].text = subst_strings[s].replace('$PNUM', str(actual_slide_num))
-
-    # Save the updated SVG file
-    tmpdoc = copy.deepcopy(doc)
-    tmp_layers = tmpdoc.findall('/svg:g[@inkscape:groupmode="layer"]', namespaces=ns)
-    for tmp_l in tmp_layers:
-        if 'style' in tmp_l.attrib.keys() and tmp_l.attrib['style'] == 'display:none':
-            tmp_l.getparent().remove(tmp_l)
-    tmpdoc.write(tmpsvg)
-    # To check if the file has been modified, save another copy without the "defs" element.
-    # Layers marked as not visible can change this section, triggering a full render of
-    # all slides for small changes. To prevent this we only compare the new svg to the
-    # previous one with defs stripped.
-    tmp_layers = tmpdoc.findall('/svg:defs', namespaces=ns)
-    for tmp_l in tmp_layers:
-        tmp_l.getparent().remove(tmp_l)
-    # text and tspan elements can swap ids even with small changes in different slides. Remove those
-    # ids to prevent artificial rerendering of all doc
-    text_elements = tmpdoc.findall('//*text', namespaces=ns)
-    for text_element in text_elements:
-        etree.strip_attributes(text_element,'id')
-    tspan_elements = tmpdoc.findall('//*tspan', namespaces=ns)
-    for tspan_element in tspan_elements:
-        etree.strip_attributes(tspan_element,'id')
-    tmpdoc.write(tmpsvg+"_no_defs")
+    num_str = str(state.actual_slide_num)
+    for element, parts in zip(subst_elements, subst_templates):
+        element.text = num_str.join(parts)
 
     # Call Inkscape to render it
-    pdf_name = tmpdir + os.path.sep + "slide-{:03d}_{:03d}.pdf".format(slide_num, page_count)
-    page_count += 1
-    pdf_path_list += pdf_name + " "
+    slide_name = "slide-{:03d}_{:03d}".format(state.slide_num, state.page_count)
+    pdf_name = tmpdir + os.path.sep + slide_name + ".pdf"
+    state.page_count += 1
     
-    # Check if it's neccesary to render this file again
-    final_svg_name = tmpdir+os.path.sep+"slide-{:03d}_{:03d}.svg".format(slide_num, page_count-1)
-    if os.path.isfile(pdf_name):
-        if os.path.isfile(final_svg_name+"_no_defs") and \
-                filecmp.cmp(final_svg_name+"_no_defs", tmpsvg+"_no_defs"):
-            # already created this svg, just move on
-            print("Skipping "+pdf_name)
-            # Restore things back to the way they were for the next run
-            for vl in visible_layers + additional_layers:
-                vl.attrib['style'] = 'display:none'
-            continue
+    # Check if it's neccesary to render this file again. Rendered pdfs are cached by
+    # the hash of their svg, so slides that were renamed, reordered or repeated are
+    # not rendered again either.
+    key = slide_hash(doc)
+    cache_pdf = cachedir + os.path.sep + key + ".pdf"
+    pages.append((cache_pdf, pdf_name))
+    if os.path.isfile(cache_pdf):
+        # already created this svg, just move on. Mark it as used so it is not pruned
+        os.utime(cache_pdf)
+        print("Skipping "+pdf_name)
+        continue
 
-    # this is a new svg, move it to its final location
-    os.system("mv "+tmpsvg+" "+final_svg_name)
-    os.system("mv "+tmpsvg+"_no_defs"+" "+final_svg_name+"_no_defs")
+    if key not in queued_keys:
+        # this is a new svg, write it to its final location. Instead of working on a
+        # copy of the whole document, hidden layers are detached from it while
+        # writing and put back afterwards.
+        final_svg_name = tmpdir + os.path.sep + slide_name + ".svg"
+        detached = [] # (parent, index, element) for every element taken out of doc
+        for tmp_l in layer_xpath(doc):
+            if tmp_l.get('style') == 'display:none':
+                parent = tmp_l.getparent()
+                detached.append((parent, parent.index(tmp_l), tmp_l))
+                parent.remove(tmp_l)
+        doc.write(final_svg_name, xml_declaration=True)
+        # Put back everything that was removed, in reverse order so indices remain valid
+        for parent, index, element in reversed(detached):
+            parent.insert(index, element)
 
-    print("Exporting {id} as {name}".format(id=l.attrib['id'], name=pdf_name))
-    # calling inkscape with "export-ignore-filters" prevents rasterization of embedded pdfs
-    os.system("inkscape --export-ignore-filters --export-filename={path} --export-area-page {svgfile}".format(path=pdf_name, svgfile=final_svg_name))
+        print("Exporting {id} as {name}".format(id=l.attrib['id'], name=pdf_name))
+        render_queue.append((final_svg_name, cache_pdf))
+        queued_keys.add(key)
 
-    # Restore things back to the way they were for the next run
-    for vl in visible_layers + additional_layers:
-        vl.attrib['style'] = 'display:none'
+# Restore things back to the way they were
+for vl in prev_visible:
+    vl.attrib['style'] = 'display:none'
+
+# Render all modified slides. The queue is split into one batch per cpu, and
+# each batch is rendered by its own inkscape session, so that the startup cost
+# of inkscape is only paid once per batch and batches run in parallel. If a daemon
+# is running, all slides are sent to it instead and inkscape is not started at all.
+# Every rendered pdf is reported through the rendered queue, so the pages can
+# be merged while the rest are still being rendered.
+# calling inkscape with "export-ignore-filters" prevents rasterization of embedded pdfs
+def render_batch(batch, rendered, open_shell):
+    reported = 0
+    try:
+        shell = open_shell()
+        for svg, pdf in batch:
+            # export to a different name first, so a crash does not leave a broken pdf in the cache
+            partial_pdf = pdf[:-len(".pdf")] + ".partial.pdf"
+            # the daemon may run from a different directory, so use absolute paths
+            # close the document once exported, so long lived shells do not accumulate them
+            command = "file-open:{svg}; export-filename:{pdf}; export-area-page; " \
+                    "export-ignore-filters; export-do; file-close;\n".format(
+                            svg=os.path.abspath(svg), pdf=os.path.abspath(partial_pdf))
+            # a leftover from an earlier crash must not be taken for this export
+            if os.path.lexists(partial_pdf):
+                os.remove(partial_pdf)
+            if not shell.run(command):
+                break
+            if os.path.isfile(partial_pdf):
+                os.replace(partial_pdf, pdf)
+            rendered.put(pdf)
+            reported += 1
+        return shell.close()
+    finally:
+        # Whatever happened, do not leave the merge waiting for these pdfs
+        for svg, pdf in batch[reported:]:
+            rendered.put(pdf)
+
+def merge_pdfs(pages, pending, rendered, out_path):
+    # Join all pages in order, waiting for the ones that are still being rendered
+    writer = PdfWriter()
+    try:
+        finished = set()
+        failed = False
+        for cache_pdf, pdf_name in pages:
+            while cache_pdf in pending and cache_pdf not in finished:
+                finished.add(rendered.get())
+            if os.path.isfile(cache_pdf):
+                link_pdf(cache_pdf, pdf_name)
+                try:
+                    writer.append(pdf_name)
+                except PyPdfError as e:
+                    # a broken pdf in the cache, remove it so it is rendered again next time
+                    print("Failed to read {} ({})".format(pdf_name, e))
+                    failed = True
+                    os.remove(cache_pdf)
+                    os.remove(pdf_name)
+            else:
+                print("Failed to render "+pdf_name)
+                failed = True
+                if os.path.lexists(pdf_name):
+                    # do not leave an outdated version of the slide around
+                    os.remove(pdf_name)
+        if failed:
+            print("Failed to combine pdfs! Some slides could not be rendered")
+        else:
+            writer.write(out_path)
+            print("Output written to {}".format(out_path))
+            # all renders are done at this point, so nothing is still writing to the cache
+            prune_cache()
+    except (OSError, PyPdfError) as e:
+        print("Failed to combine pdfs! {}".format(e))
+    finally:
+        writer.close()
 
-# Merge everything using pdftk
+# Merge everything using pypdf, in a separate thread
 out_path = srcfile[:-4] + '.pdf'
-if os.system("pdftk "+pdf_path_list+" cat output {}".format(out_path)):
-    print("Failed to combine pdfs!  Check that pdftk is installed")
-else:
-    print("Output written to {}".format(out_path))
+rendered = queue.Queue()
+pending = set(pdf for svg, pdf in render_queue)
+merger = threading.Thread(target=merge_pdfs, args=(pages, pending, rendered, out_path))
+merger.start()
+
+if len(render_queue) > 0:
+    if daemon_running(daemon_socket):
+        # every batch gets its own connection, and with it one of the daemon's shells
+        print("Rendering with the inkscape daemon at "+daemon_socket)
+        open_shell = lambda: DaemonShell(daemon_socket)
+    else:
+        open_shell = InkscapeShell
+    num_workers = min(os.cpu_count() or 1, len(render_queue))
+    batches = [render_queue[k::num_workers] for k in range(num_workers)]
+    # The heavy lifting happens in the inkscape processes, threads are enough to drive them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(render_batch, batch, rendered, open_shell) for batch in batches]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                if future.result() != 0:
+                    print("Inkscape exited with an error while rendering slides")
+            except FileNotFoundError as e:
+                print("Failed to run inkscape! Check that it is installed ({})".format(e))
+            except OSError as e:
+                print("Failed to render slides! ({})".format(e))
 
+merger.join()